@@ -25,6 +25,11 @@ from google import genai
 from google.genai import types
 from werkzeug.utils import secure_filename
 
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
 # 配置详细日志
 logging.basicConfig(
     level=logging.INFO, 
@@ -214,14 +219,196 @@ def scan_models():
         
     return sorted(ms, key=lambda x: x['name'])
 
-# ★★★ 关键修复：补回 scan_backgrounds 函数 ★★★
+# --- 背景图片管理 (缩放 + WebP 变体 + 缓存索引) ---
+BG_VARIANT_DIR = os.path.join(BG_DIR, "variants")
+BG_INDEX_FILE = os.path.join(BG_VARIANT_DIR, "index.json")
+BG_EXTS = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+BG_WIDTHS = [720, 1280, 1920, 2560]   # 不同屏幕使用的目标宽度，最大不超过 2560
+BG_THUMB_WIDTH = 160                  # Studio 网格缩略图
+BG_WEBP_QUALITY = 80
+BG_SCAN_INTERVAL = 60                 # 目录无变化时，逐文件检查的最长间隔 (秒)
+
+BG_INDEX = {}                   # {文件名: {w, h, mtime, thumb, variants: {宽度: 相对路径}}}
+BG_INDEX_LOCK = threading.Lock()
+_bg_pending = set()             # 等待后台处理的文件
+_bg_busy = set()                # 正在处理的文件 (上传 / 后台任务)
+_bg_worker_running = False
+_bg_generation = 0              # 索引每次变化 +1，作为列表缓存键的一部分
+_bg_scan_key = None
+_bg_scan_time = 0
+_bg_scan_result = []
+
+def load_bg_index():
+    if os.path.exists(BG_INDEX_FILE):
+        try:
+            with open(BG_INDEX_FILE, 'r', encoding='utf-8') as f: BG_INDEX.update(json.load(f))
+        except Exception as e:
+            logging.error(f"⚠️ 背景索引加载错误: {e}")
+
+def save_bg_index():
+    global _bg_generation
+    _bg_generation += 1
+    try:
+        os.makedirs(BG_VARIANT_DIR, exist_ok=True)
+        with open(BG_INDEX_FILE, 'w', encoding='utf-8') as f:
+            json.dump(BG_INDEX, f, ensure_ascii=False)
+    except Exception as e:
+        logging.error(f"❌ 保存背景索引失败: {e}")
+
+def bg_variant_files(entry):
+    return [p for p in [entry.get('thumb')] + list(entry.get('variants', {}).values()) if p]
+
+def remove_bg_files(rels):
+    for rel in rels:
+        try: os.remove(os.path.join(BG_DIR, rel))
+        except OSError: pass
+
+def bg_entry_stale(name, entry):
+    """源文件被替换、变体文件丢失、或安装 Pillow 后尚未处理时需要重新生成"""
+    if not entry: return True
+    try:
+        if entry.get('mtime') != os.path.getmtime(os.path.join(BG_DIR, name)): return True
+    except OSError: return False
+    if Image is not None and not entry.get('thumb') and not entry.get('error'): return True
+    return not all(os.path.exists(os.path.join(BG_DIR, rel)) for rel in bg_variant_files(entry))
+
+def is_valid_image(path):
+    """上传校验：没有 Pillow 时只能信任扩展名"""
+    if Image is None: return True
+    try:
+        with Image.open(path) as im: im.verify()
+        return True
+    except Exception:
+        return False
+
+def process_background(name):
+    """为单张背景生成 WebP 变体与缩略图，返回索引条目；源文件不存在时返回 None"""
+    src = os.path.join(BG_DIR, name)
+    try:
+        entry = {"w": 0, "h": 0, "mtime": os.path.getmtime(src), "thumb": "", "variants": {}}
+    except OSError:
+        return None
+    if Image is None:
+        logging.warning("⚠️ 未安装 Pillow，背景仅使用原图")
+        return entry
+
+    written = []
+    def _save(img, suffix):
+        # 变体名包含完整文件名 (含扩展名)，避免 bg.jpg / bg.png 互相覆盖
+        rel = f"variants/{name}_{suffix}.webp"
+        written.append(rel)
+        img.save(os.path.join(BG_DIR, rel), "WEBP", quality=BG_WEBP_QUALITY, method=4)
+        return rel
+
+    def _shrink(img, width):
+        if width >= img.width: return img
+        return img.resize((width, max(1, round(img.height * width / img.width))), Image.LANCZOS, reducing_gap=3.0)
+
+    try:
+        os.makedirs(BG_VARIANT_DIR, exist_ok=True)
+        with Image.open(src) as im:
+            animated = getattr(im, "is_animated", False)
+            # EXIF 旋转 90° 时显示宽度是原始高度
+            rotated = im.getexif().get(0x0112, 1) in (5, 6, 7, 8)
+            w, h = (im.height, im.width) if rotated else im.size
+            entry["w"], entry["h"] = w, h
+            if im.format == "JPEG" and w > BG_WIDTHS[-1]:
+                # JPEG 解码时直接按 1/2、1/4… 缩小，避免整张 12MP 图进内存
+                s = BG_WIDTHS[-1] / w
+                im.draft("RGB", (int(im.width * s) + 1, int(im.height * s) + 1))
+            im = ImageOps.exif_transpose(im)
+            im = im.convert("RGBA" if im.mode in ("RGBA", "LA", "P") else "RGB")
+
+            # 动图保留原文件，只生成静态缩略图；不放大小图，最大宽度封顶 BG_WIDTHS[-1]
+            if not animated:
+                widths = [bw for bw in BG_WIDTHS if bw < w]
+                if w <= BG_WIDTHS[-1]: widths.append(w)
+                # 从大到小逐级缩放，每一级都以上一级结果为源
+                for bw in sorted(widths, reverse=True):
+                    im = _shrink(im, bw)
+                    entry["variants"][str(bw)] = _save(im, bw)
+            entry["thumb"] = _save(_shrink(im, BG_THUMB_WIDTH), "thumb")
+        logging.info(f"🖼️ 背景处理完成: {name} ({entry['w']}x{entry['h']}, {len(entry['variants'])} 个变体)")
+    except Exception as e:
+        remove_bg_files(written)
+        entry.update(thumb="", variants={}, error=True)
+        logging.error(f"❌ 背景处理失败 {name}: {e}")
+    return entry
+
+def store_background(name, entry):
+    with BG_INDEX_LOCK:
+        _bg_busy.discard(name)
+        if entry is None: return
+        # 同名文件被替换后，清理新条目中已不再使用的旧变体
+        old = BG_INDEX.get(name)
+        if old: remove_bg_files(set(bg_variant_files(old)) - set(bg_variant_files(entry)))
+        BG_INDEX[name] = entry
+        save_bg_index()
+
+def process_pending_backgrounds():
+    """后台任务：逐个处理待处理背景，不在锁内做图片编码"""
+    global _bg_worker_running
+    while True:
+        with BG_INDEX_LOCK:
+            if not _bg_pending:
+                _bg_worker_running = False
+                return
+            name = _bg_pending.pop()
+            _bg_busy.add(name)
+        store_background(name, process_background(name))
+
+def queue_backgrounds(names):
+    """加入待处理队列，必要时启动后台任务"""
+    global _bg_worker_running
+    with BG_INDEX_LOCK:
+        _bg_pending.update(n for n in names if n not in _bg_busy)
+        start = bool(_bg_pending) and not _bg_worker_running
+        if start: _bg_worker_running = True
+    if start: socketio.start_background_task(process_pending_backgrounds)
+
+def bg_dir_mtime(path):
+    try: return os.path.getmtime(path)
+    except OSError: return 0
+
 def scan_backgrounds():
-    bgs = []
+    """返回背景列表 (已构建好的前端数据)；目录与索引都没变化时直接返回缓存"""
+    global _bg_scan_key, _bg_scan_time, _bg_scan_result
     if not os.path.exists(BG_DIR): return []
-    for ext in ['*.jpg', '*.jpeg', '*.png', '*.webp', '*.gif']:
-        for f in glob.glob(os.path.join(BG_DIR, ext)): 
-            bgs.append(os.path.basename(f))
-    return sorted(bgs)
+    # 原地覆盖同名文件不会改变目录 mtime，因此缓存最多保留 BG_SCAN_INTERVAL 秒
+    key = (bg_dir_mtime(BG_DIR), bg_dir_mtime(BG_VARIANT_DIR), _bg_generation)
+    if key == _bg_scan_key and time.time() - _bg_scan_time < BG_SCAN_INTERVAL:
+        return list(_bg_scan_result)
+
+    # 文件系统检查在锁外进行，只在更新索引时持锁
+    names = [f for f in os.listdir(BG_DIR) if f.lower().endswith(BG_EXTS) and os.path.isfile(os.path.join(BG_DIR, f))]
+    with BG_INDEX_LOCK: snapshot = dict(BG_INDEX)
+    stale = [n for n in names if bg_entry_stale(n, snapshot.get(n))]
+
+    with BG_INDEX_LOCK:
+        removed = [n for n in BG_INDEX if n not in names and n not in _bg_busy]
+        for n in removed: remove_bg_files(bg_variant_files(BG_INDEX.pop(n)))
+        if removed: save_bg_index()
+        result = [bg_payload(n) for n in sorted(names)]
+        _bg_scan_key = (bg_dir_mtime(BG_DIR), bg_dir_mtime(BG_VARIANT_DIR), _bg_generation)
+        _bg_scan_time = time.time()
+        _bg_scan_result = result
+    queue_backgrounds(stale)
+    return list(result)
+
+def bg_payload(name):
+    """前端使用的背景信息：原图 + 各宽度变体，由客户端按屏幕选择"""
+    if not name: return {'name': '', 'url': '', 'thumb': '', 'variants': []}
+    e = BG_INDEX.get(name, {})
+    return {
+        'name': name,
+        'url': f"/static/backgrounds/{name}",
+        'thumb': f"/static/backgrounds/{e['thumb']}" if e.get('thumb') else "",
+        'variants': sorted(({'w': int(w), 'url': f"/static/backgrounds/{rel}"} for w, rel in e.get('variants', {}).items()), key=lambda v: v['w'])
+    }
+
+# 启动时加载索引，并在后台处理已有但未生成变体的背景
+load_bg_index()
+scan_backgrounds()
 
 def init_model():
     global CURRENT_MODEL
@@ -373,7 +560,29 @@ def update_key():
 def upload_bg():
     f = request.files.get('file')
     if f: 
-        f.save(os.path.join(BG_DIR, f"{int(time.time())}_{secure_filename(f.filename)}"))
+        # 先取扩展名再清洗文件名，secure_filename 会去掉中文字符
+        stem, ext = os.path.splitext(f.filename)
+        ext = ext.lower()
+        if ext not in BG_EXTS:
+            return jsonify({'success': False, 'msg': '不支持的图片格式'})
+        # 纯中文文件名清洗后为空，用随机名避免同一秒内的上传互相覆盖
+        name = f"{int(time.time())}_{secure_filename(stem) or uuid.uuid4().hex[:8]}{ext}"
+        path = os.path.join(BG_DIR, name)
+        # 保存和校验期间标记为 busy，防止扫描提前处理半成品文件
+        with BG_INDEX_LOCK: _bg_busy.add(name)
+        try:
+            f.save(path)
+            ok = is_valid_image(path)
+            if not ok: os.remove(path)
+        except Exception as e:
+            logging.error(f"❌ 背景上传失败: {e}")
+            if os.path.exists(path): os.remove(path)
+            return jsonify({'success': False, 'msg': '保存失败'})
+        finally:
+            with BG_INDEX_LOCK: _bg_busy.discard(name)
+        if not ok: return jsonify({'success': False, 'msg': '文件不是有效图片'})
+        # 缩放编码交给后台任务，不占用请求线程
+        queue_backgrounds([name])
         return jsonify({'success': True})
     return jsonify({'success': False})
 
@@ -467,7 +676,7 @@ def on_login(d):
     join_room('lobby')
     if not chatroom_chat: init_chatroom()
     
-    emit('login_success', {'username': u, 'current_model': CURRENT_MODEL, 'current_background': GLOBAL_STATE.get('current_background', '')})
+    emit('login_success', {'username': u, 'current_model': CURRENT_MODEL, 'current_background': GLOBAL_STATE.get('current_background', ''), 'background': bg_payload(GLOBAL_STATE.get('current_background', ''))})
     emit('history_sync', {'history': GLOBAL_STATE['chat_history']})
     
     # 异步欢迎语
@@ -506,12 +715,15 @@ def on_get_data():
         logging.warning("⚠️ 未找到任何 Live2D 模型")
         models = [] # 给一个空列表，前端会显示“无模型”
 
+    bgs = scan_backgrounds()
+
     # 发送数据
     emit('studio_data', {
         'models': models, 
         'current_id': CURRENT_MODEL['id'], 
         'voices': voices, 
-        'backgrounds': scan_backgrounds(), # 修复了这里的 NameError
+        'backgrounds': [b['name'] for b in bgs],
+        'background_thumbs': {b['name']: b['thumb'] for b in bgs},
         'current_bg': GLOBAL_STATE.get('current_background', ''),
         'gemini_key_status': 'OK' if gemini_client else 'MISSING',
         'acgn_config': acgn_config
@@ -543,7 +755,7 @@ def on_sav(d):
 @socketio.on('switch_background')
 def on_sw_bg(d):
     GLOBAL_STATE['current_background'] = d.get('name'); save_state()
-    emit('background_update', {'url': f"/static/backgrounds/{d.get('name')}" if d.get('name') else ""}, to='lobby')
+    emit('background_update', bg_payload(d.get('name')), to='lobby')
 
 if __name__ == '__main__':
     logging.info("🚀 Starting Pico AI Server (Heavy Armor Fixed)...")
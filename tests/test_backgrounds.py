@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# 背景图片处理流水线测试：python -m pytest -q
+import io
+import os
+import re
+import sys
+import time
+
+import pytest
+
+pytest.importorskip("flask_socketio")
+pytest.importorskip("google.genai")
+pytest.importorskip("edge_tts")
+Image = pytest.importorskip("PIL.Image")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+
+@pytest.fixture
+def bg_dir(tmp_path, monkeypatch):
+    """使用临时背景目录，后台任务改为同步执行"""
+    d = str(tmp_path)
+    monkeypatch.setattr(app, "BG_DIR", d)
+    monkeypatch.setattr(app, "BG_VARIANT_DIR", os.path.join(d, "variants"))
+    monkeypatch.setattr(app, "BG_INDEX_FILE", os.path.join(d, "variants", "index.json"))
+    monkeypatch.setattr(app, "BG_INDEX", {})
+    monkeypatch.setattr(app, "_bg_pending", set())
+    monkeypatch.setattr(app, "_bg_busy", set())
+    monkeypatch.setattr(app, "_bg_worker_running", False)
+    monkeypatch.setattr(app, "_bg_scan_key", None)
+    monkeypatch.setattr(app, "_bg_scan_result", [])
+    monkeypatch.setattr(app.socketio, "start_background_task", lambda fn, *a: fn(*a))
+    return d
+
+
+def make_image(d, name, size, color="red", **kw):
+    p = os.path.join(d, name)
+    Image.new("RGB", size, color).save(p, **kw)
+    return p
+
+
+def upload(bg_dir, filename, data=None):
+    if data is None:
+        with open(make_image(bg_dir, "src.png", (300, 200)), "rb") as f: data = f.read()
+        os.remove(os.path.join(bg_dir, "src.png"))
+    return app.app.test_client().post("/upload_bg", data={"file": (io.BytesIO(data), filename)}, content_type="multipart/form-data").get_json()
+
+
+def test_variants_are_capped_and_not_upscaled(bg_dir):
+    make_image(bg_dir, "big.jpg", (4000, 2000))
+    make_image(bg_dir, "small.png", (500, 300))
+    app.scan_backgrounds()
+
+    big = app.bg_payload("big.jpg")
+    assert [v["w"] for v in big["variants"]] == [720, 1280, 1920, 2560]
+    assert big["thumb"].endswith("big.jpg_thumb.webp")
+    assert [v["w"] for v in app.bg_payload("small.png")["variants"]] == [500]
+
+
+def test_same_stem_does_not_collide(bg_dir):
+    make_image(bg_dir, "bg.jpg", (800, 600), "red")
+    make_image(bg_dir, "bg.png", (800, 600), "blue")
+    app.scan_backgrounds()
+    assert set(app.bg_variant_files(app.BG_INDEX["bg.jpg"])).isdisjoint(app.bg_variant_files(app.BG_INDEX["bg.png"]))
+
+    os.remove(os.path.join(bg_dir, "bg.jpg"))
+    names = [b["name"] for b in app.scan_backgrounds()]
+    assert names == ["bg.png"]
+    assert all(os.path.exists(os.path.join(bg_dir, rel)) for rel in app.bg_variant_files(app.BG_INDEX["bg.png"]))
+
+
+def test_large_rotated_jpeg_uses_display_width(bg_dir):
+    exif = Image.Exif()
+    exif[0x0112] = 6  # 旋转 90°
+    make_image(bg_dir, "r.jpg", (4000, 3000), exif=exif.tobytes())
+    app.scan_backgrounds()
+
+    e = app.BG_INDEX["r.jpg"]
+    assert (e["w"], e["h"]) == (3000, 4000)
+    assert sorted(int(w) for w in e["variants"]) == [720, 1280, 1920, 2560]
+    with Image.open(os.path.join(bg_dir, e["variants"]["2560"])) as im:
+        assert im.width == 2560
+
+
+def test_listing_is_cached_until_directory_changes(bg_dir, monkeypatch):
+    make_image(bg_dir, "a.jpg", (800, 600))
+    app.scan_backgrounds()
+    # 后台处理完成会改变索引，下一次扫描重建一次列表 (带上缩略图)
+    assert app.scan_backgrounds()[0]["thumb"]
+
+    calls = []
+    monkeypatch.setattr(app, "bg_entry_stale", lambda *a: calls.append(a) or False)
+    app.scan_backgrounds()
+    assert calls == []
+
+
+def test_failed_processing_leaves_no_orphans(bg_dir, monkeypatch):
+    make_image(bg_dir, "a.jpg", (3000, 2000))
+    real_save = Image.Image.save
+    saves = []
+
+    def flaky_save(self, *a, **kw):
+        saves.append(a)
+        if len(saves) == 2: raise OSError("disk full")
+        return real_save(self, *a, **kw)
+
+    monkeypatch.setattr(Image.Image, "save", flaky_save)
+    e = app.process_background("a.jpg")
+    assert e["error"] and e["thumb"] == "" and e["variants"] == {}
+    assert os.listdir(os.path.join(bg_dir, "variants")) == []
+
+
+def test_replaced_or_missing_variants_are_regenerated(bg_dir, monkeypatch):
+    monkeypatch.setattr(app, "BG_SCAN_INTERVAL", 0)
+    src = make_image(bg_dir, "a.jpg", (1000, 500))
+    app.scan_backgrounds()
+    assert app.BG_INDEX["a.jpg"]["w"] == 1000
+
+    make_image(bg_dir, "a.jpg", (1500, 500))
+    later = time.time() + 10
+    os.utime(src, (later, later))
+    app.scan_backgrounds()
+    assert app.BG_INDEX["a.jpg"]["w"] == 1500
+
+    thumb = os.path.join(bg_dir, app.BG_INDEX["a.jpg"]["thumb"])
+    os.remove(thumb)
+    app.scan_backgrounds()
+    assert os.path.exists(thumb)
+
+
+def test_vanished_file_is_skipped(bg_dir):
+    assert app.process_background("missing.jpg") is None
+    app.store_background("missing.jpg", None)
+    assert "missing.jpg" not in app.BG_INDEX
+
+
+def test_without_pillow_serves_original(bg_dir, monkeypatch):
+    make_image(bg_dir, "a.jpg", (1000, 500))
+    monkeypatch.setattr(app, "Image", None)
+    bgs = app.scan_backgrounds()
+    assert bgs[0]["url"] == "/static/backgrounds/a.jpg"
+    assert bgs[0]["variants"] == [] and bgs[0]["thumb"] == ""
+
+
+def test_upload_of_non_ascii_names_gets_unique_stem(bg_dir):
+    assert upload(bg_dir, "背景.png")["success"]
+    assert upload(bg_dir, "背景.png")["success"]
+
+    names = list(app.BG_INDEX)
+    assert len(names) == 2
+    assert all(re.fullmatch(r"\d+_[0-9a-f]{8}\.png", n) for n in names)
+    assert all(app.BG_INDEX[n]["thumb"] for n in names)
+
+
+def test_upload_rejects_non_image(bg_dir):
+    r = upload(bg_dir, "a.png", b"notimage")
+    assert not r["success"] and r["msg"]
+    assert os.listdir(bg_dir) == []
+    assert app.BG_INDEX == {} and app._bg_busy == set()